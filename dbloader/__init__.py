@@ -1,13 +1,14 @@
 # Tasker
 # Task management, database loading and logging layer on top of keeper
-import os, sys
+import os, sys, time
 import re
-import pandas as pd
-import numpy as np
 from datetime import datetime
-from hudkeep import store, retrieve, local_props, blob_props
 from sqltools import run_query, pyodbc_conn
-from taskmaster import dump_result
+from taskmaster import dump_result, IS_TTY
+
+# UPDATE statements used by set_log(), keyed by table and (sorted) columns so
+# the same statement text is sent each time and can be reused by the server
+SET_LOG_QUERIES = {}
 
 class DBLoadTask:
     def __init__(self, task_name, table_name, schema, database = "property", log_table_name = "dbtask_logs"):
@@ -41,6 +42,7 @@ class DBLoadTask:
         t.dump_result()
         """
         self.conn = pyodbc_conn(database)
+        self.log_cur = self.conn.cursor() # Kept for set_log(), so pyodbc can reuse its prepared statement
         self.task_name = task_name
         self.table_name = table_name
         self.schema = schema
@@ -77,6 +79,7 @@ class DBLoadTask:
             If true, will ignore hash check and store regardless of existing
             files.
         """
+        from hudkeep import store, local_props # Only needed for storing
         # Don't store if already stored, unless forced to
         store_status = self.log["store_status"]
         if store_status == "success":
@@ -143,6 +146,7 @@ class DBLoadTask:
         **kwargs : dict
             Additional arguments are passed to the loader.
         """
+        from hudkeep import retrieve # Only needed for loading
         # Don't load if store was not successful
         # If you want to force this, force store()
         store_status = self.log["store_status"]
@@ -178,9 +182,9 @@ class DBLoadTask:
         blob_fn = f"{blob_path}/{fn}"
         local_fn = f"temp/{fn}"
         retrieve(local_fn, blob_fn, container_url)
-        start = datetime.now()
+        start = time.perf_counter()
         row_count = loader(local_fn, self, **kwargs)
-        log_msg(f"'{self.task_name}' loaded ({row_count} rows) in {datetime.now() - start}s.", "success")
+        log_msg(f"'{self.task_name}' loaded ({row_count} rows) in {time.perf_counter() - start:.2f}s.", "success")
         os.remove(local_fn) # Clean up
         self.set_log({
             "row_count": row_count,
@@ -228,12 +232,15 @@ class DBLoadTask:
         return self.log
 
     def set_log(self, props):
-        cur = self.conn.cursor()
-        keys = ",".join([f"{k} = ?" for k in props.keys()])
-        cur.execute(
-            f"UPDATE [{self.schema}].[{self.log_table_name}] SET {keys} WHERE task_name = ?",
-            *props.values(), self.task_name)
-        cur.commit()
+        keys = tuple(sorted(props.keys()))
+        query_key = (self.schema, self.log_table_name, keys)
+        query = SET_LOG_QUERIES.get(query_key)
+        if not query:
+            set_str = ",".join([f"{k} = ?" for k in keys])
+            query = f"UPDATE [{self.schema}].[{self.log_table_name}] SET {set_str} WHERE task_name = ?"
+            SET_LOG_QUERIES[query_key] = query
+        self.log_cur.execute(query, *[props[k] for k in keys], self.task_name)
+        self.log_cur.commit()
         self.log = self.get_log()
         return self.log
 
@@ -293,7 +300,7 @@ def log_msg(message, status_type):
         colour = "\033[0;33m"
     elif status_type == "error":
         colour = "\033[1;31m"
-    print(f"{colour}{message}\033[0m")
+    print(f"{colour}{message}\033[0m" if IS_TTY else message)
 
 # Generate a DBLoader task card for sending via Teams
 def dbload_card(t, facts = None):
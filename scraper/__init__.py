@@ -1,12 +1,12 @@
 # Scraper
 # Tools for getting data
 import json, requests, re, gzip
-import pandas as pd
 from pathlib import Path
 from datetime import datetime
 from zipfile import ZipFile
 from bs4 import BeautifulSoup
 from io import StringIO
+# pandas is slow to import and only used for charts, so it is imported there
 
 def get_link(raw_page, ln_pattern, host = ""):
     soup = BeautifulSoup(raw_page, "html.parser")
@@ -154,5 +154,6 @@ class StatsNZ:
             raise Exception(f"More than one chart found! Check your title_pattern ({title_pattern}).")
         else:
             csv_file = StringIO(targ_series[0]["GraphCsvData"])
+            import pandas as pd
             df = pd.read_csv(csv_file)
             return df
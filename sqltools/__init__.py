@@ -3,11 +3,11 @@ import struct
 import pyodbc
 import math, itertools
 import subprocess
-import pandas as pd
 from datetime import datetime
 from sqlalchemy import event
 from sqlalchemy.engine import URL, create_engine
 from azure.identity import AzureCliCredential
+# pandas is slow to import, so it is imported inside the functions that return DataFrames
 
 csv.field_size_limit(sys.maxsize)
 
@@ -34,6 +34,7 @@ def query_to_df(query, database):
     print("Extracting results...")
     cols = [c[0] for c in cur.description]
     raw = [dict(zip(cols, r)) for r in cur.fetchall()]
+    import pandas as pd
     df = pd.DataFrame(raw)
     print(f"{len(df)} rows in results...")
     return df
@@ -319,6 +320,7 @@ def bcp_loader(local_fn, task, conn_str, if_exists = "append", delimiter = "|",
     start = datetime.now()
     cols = get_columns(table_name, schema, database) # Use datatypes from table
     dtype, parse_dates = sql_types_to_pandas_types(cols)
+    import pandas as pd
     df = pd.read_csv(local_fn, dtype = dtype, parse_dates = None) # Don't parse dates, bcp will take care of it
     df.to_csv(temp_fn, sep = delimiter, index = False) # Read and save to use Pandas to clean CSV file
     print(f"File cleaning took {datetime.now() - start}s...")
@@ -366,6 +368,7 @@ def sqlalchemy_loader(local_fn, task, encoding = "utf-8", strict_mode = True, if
     table_name = task.table_name
     schema = task.schema
     database = task.database
+    import pandas as pd
     df = pd.read_csv(local_fn, dtype = str, encoding = encoding)
     if df.memory_usage().sum() > 50000000:
         print("\033[1;33mCAUTION! sqlalchemy_loader() might have trouble handling large files, consider using sql_loader().\033[0m")
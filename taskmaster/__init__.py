@@ -1,11 +1,12 @@
 #!/bin/python3
-import os, sys, argparse, pathlib
-import re, json, asyncio, hashlib
-import pandas as pd
+import os, sys, time, sqlite3, argparse, pathlib, threading, subprocess
+import re, json, mmap, asyncio, hashlib, inspect, itertools
+from collections import Counter, OrderedDict, deque
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from sqltools import insert, update, delete
-from chatter import send_card
 
+IS_TTY = sys.stdout.isatty() # Colours and the in-place screen are only for terminals
 STATUSES = {
     "unassigned": "\033[0;35m",
     "success": "\033[0;32m",
@@ -17,22 +18,67 @@ STATUSES = {
     "default": "\033[1;31m",
     "reset": "\033[0m"
 }
+# Colours actually used, blanked out when we're not writing to a terminal
+STATUS_COLOURS = STATUSES if IS_TTY else dict.fromkeys(STATUSES, "")
+# Pre-rendered "[status]" tags for draw_branch()
+STATUS_TAGS = { k: f"[{v}{k}{STATUS_COLOURS['reset']}]" for k,v in STATUS_COLOURS.items() if k not in ("default", "reset") }
+
+# Seconds to wait before repainting the status screen, so bursts of changes are drawn together
+REDRAW_DELAY = 0.05
+# Statuses that let children go ahead
+DONE_STATUSES = ("success", "unchanged")
+
+# Result blocks printed by dump_result(), compiled once
+RESULT_EXP = re.compile(r"== RESULT START ==\n(.*?)\n== RESULT END ==", re.DOTALL)
+# Used by hash_file() for output hashes
+# sha256 is hardware accelerated on most current CPUs, and faster than md5 there
+# Changing this invalidates hashes already in the task log, so every task runs once more
+HASH_ALGORITHM = "sha256"
+# Most files hashed at once for a single task, more than this just thrashes the disk
+HASH_WORKERS = 8
+# File hashes by (path, mtime, size, algorithm), see hash_file()
+# Least recently used hashes are dropped past HASH_CACHE_SIZE, so long-lived processes don't grow forever
+HASH_CACHE = OrderedDict()
+HASH_CACHE_SIZE = 4096
+HASH_CACHE_LOCK = threading.Lock() # Shared by hashing threads
+# Columns in the task log (see Taskmaster.log_task)
+TASK_LOG_FIELDS = ["script", "status", "start", "end", "input_hashes", "output_hashes", "result"]
+TASK_LOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS task_log (script TEXT, status TEXT, start TEXT, "end" TEXT, input_hashes TEXT, output_hashes TEXT, result TEXT);
+CREATE INDEX IF NOT EXISTS task_log_last_run ON task_log (status, script, "end");
+"""
+TASK_LOG_INSERT = 'INSERT INTO task_log (script, status, start, "end", input_hashes, output_hashes, result) VALUES (?, ?, ?, ?, ?, ?, ?)'
+# SQLite fills the other columns from the row with the MAX()
+TASK_LOG_LAST_RUNS = """
+SELECT script, status, start, "end", input_hashes, output_hashes, result, MAX("end")
+FROM task_log WHERE status = 'success' GROUP BY script
+"""
 
 # The top-level definition is in jobs.json, which is a list of jobs
 # Each job has a name, job-wide parameters, and a list of steps
 # Each step is a task, or a list of tasks
 # Each task is one R/Python script
 class Taskmaster:
-    def __init__(self, jobs, run_name = "test_run", scripts_path = "modules", log_db = None):
+    def __init__(self, jobs, run_name = "test_run", scripts_path = "modules", log_db = None, task_log = None):
         print(f"Initialising run '{run_name}'...")
         self.auto = True # Start in auto mode
         self.jobs = jobs
         self.run_name = run_name
         self.run_log = {}
+        self.pending_run_log = {} # Changes not yet written to log_db
         self.scripts_path = pathlib.Path(scripts_path)
         self.log_db = log_db
+        self.task_log = task_log
+        self.task_log_rows = []
+        self.last_runs = self.read_task_log() # Read once, kept up to date in memory
         self.log_msgs = []
         self.screen = ""
+        self.redraw = None # Pending repaint, see print_status()
+        self.tree = ""
+        self.tree_statuses = None # Statuses self.tree was drawn with
+        self.python = self.find_python() # Skips pipenv for every task where we can
+        self.runners = { ".py": self.python, ".r": ["Rscript"] } # Command prefix for each script extension
+        self.spawn_pool = ThreadPoolExecutor(max_workers = 4) # Forks happen here, off the event loop
         self.create_run_log()
 
     @staticmethod
@@ -62,11 +108,12 @@ class Taskmaster:
     #=====================#
     # Runs all tasks until no ready tasks are available
     def run(self, auto = False, forced = False, only_run = None, max_tasks = 8):
-        start = datetime.now()
+        t0 = time.perf_counter_ns() # Monotonic, for elapsed time
         run_status = "running"
         self.auto = auto
         self.forced = forced
         self.tasks = tasks = self.list_tasks(self.jobs, only_run)
+        self.tree_statuses = None # New tasks, so the tree needs drawing
         self.set_run_log({
             "run_args": str({
                 "auto": forced,
@@ -78,50 +125,43 @@ class Taskmaster:
             "jobs_count": len(self.jobs),
             "tasks_count": len(tasks)
         })
+        self.flush_run_log()
         self.print_status() # Print once to allocate lines
-        while True:
-            ready = [t for t in tasks if self.is_ready(t, forced)]
-            if ready:
-                # This whole block should be rewritten in Runner or TaskGroup
-                # However, this requires Python 3.11, so holding off for now
-                # https://docs.python.org/3/library/asyncio-runner.html
-                # https://docs.python.org/3/library/asyncio-task.html#asyncio.TaskGroup
-                curr_tasks = [self.run_task(t, forced) for t in ready]
-                operation = gather_with_concurrency(curr_tasks, max_tasks)
-                loop = asyncio.get_event_loop()
-                try:
-                    loop.run_until_complete(operation)
-                except KeyboardInterrupt:
-                    self.log_msg("Aborting...", "warning")
-                    run_status = "aborted"
-                    loop.stop()
-                    break
-                except AssertionError:
-                    self.log_msg("Halting due to script error!", "error")
-                    run_status = "halted"
-                    loop.stop()
-                    break
-                except:
-                    self.log_msg("Crashed!", "error")
-                    run_status = "crashed"
-                    loop.stop()
-                    raise
-            else:
-                # No more tasks ready to run, skip any outstanding tasks
-                for t in tasks:
-                    if t["status"] == "unassigned":
-                        t["status"] = "skipped"
-                self.print_status()
-                run_status = "finished"
-                break
-        self.set_run_log({
-            "status": run_status,
-            "tasks_succeeded": sum([t["status"] == "success" for t in tasks]),
-            "tasks_failed": sum([t["status"] == "failed" for t in tasks]),
-            "tasks_skipped": sum([t["status"] == "skipped" for t in tasks]),
-            "finished_at": datetime.now()
-        })
-        self.log_msg(f"\n{run_status.upper()} in {datetime.now() - start}s.", "bold")
+        # A single event loop for the whole run; run_tasks() feeds workers as tasks become ready
+        # TaskGroup would tidy this further, but requires Python 3.11, so holding off for now
+        # https://docs.python.org/3/library/asyncio-task.html#asyncio.TaskGroup
+        try:
+            asyncio.run(self.run_tasks(tasks, forced, max_tasks))
+        except KeyboardInterrupt:
+            self.log_msg("Aborting...", "warning")
+            run_status = "aborted"
+        except AssertionError:
+            self.log_msg("Halting due to script error!", "error")
+            run_status = "halted"
+        except:
+            self.log_msg("Crashed!", "error")
+            run_status = "crashed"
+            raise
+        else:
+            # No more tasks ready to run, skip any outstanding tasks
+            for t in tasks:
+                if t["status"] == "unassigned":
+                    t["status"] = "skipped"
+            self.print_status()
+            run_status = "finished"
+        finally:
+            self.write_task_log()
+            counts = Counter(t["status"] for t in tasks)
+            self.set_run_log({
+                "status": run_status,
+                "tasks_succeeded": counts["success"],
+                "tasks_failed": counts["failed"],
+                "tasks_skipped": counts["skipped"] + counts["unchanged"],
+                "finished_at": datetime.now()
+            })
+            self.flush_run_log() # Also records runs that crashed
+        elapsed = (time.perf_counter_ns() - t0) / 1e9
+        self.log_msg(f"\n{run_status.upper()} in {elapsed:.2f}s.", "bold")
         self.on_run_complete()
 
     # Break jobs down into interdependent tasks
@@ -140,8 +180,13 @@ class Taskmaster:
                 # Link dependencies
                 for t in curr: t["parents"] = get_uniq(t["parents"] + prev)
                 for t in prev: t["children"] = get_uniq(t["children"] + curr)
+        for t in tasks.values(): t["pending_parents"] = len(t["parents"])
         self.log_msg(f"{len(jobs)} jobs with {len(tasks)} individual tasks loaded.")
         tasks = list(tasks.values())
+        ordered = { id(t) for t in get_topo_order(tasks) } # Tasks in a cycle never come up
+        if len(ordered) < len(tasks):
+            stuck = [t["script"] for t in tasks if id(t) not in ordered]
+            raise Exception(f"Circular dependencies between jobs (involving {', '.join(stuck)})!")
         if only_run:
             tasks = self.filter_tasks(tasks, only_run)
             self.log_msg(f"Limiting to {len(tasks)} tasks related to {only_run}.")
@@ -150,52 +195,142 @@ class Taskmaster:
     # Reduce task list to a selection and its ancestors
     def filter_tasks(self, tasks, only_run):
         selected = []
+        seen = set() # Shared between walks, so common ancestors are only visited once
         for t in tasks:
-            if t["script"] in only_run:
+            if t["script"] in only_run and id(t) not in seen:
+                seen.add(id(t))
                 selected.append(t)
-                selected += get_ancestors(t)
-        selected = get_uniq(selected)
+                selected += get_relatives(t, "parents", seen)
         for t in selected:
-            t["children"] = [c for c in t["children"] if c in selected]
+            t["children"] = [c for c in t["children"] if id(c) in seen]
         return selected
 
     # Checks whether a task is ready to run
     def is_ready(self, t, forced):
         if t["status"] != "unassigned": return False # Already ran/running
         for d in t.get("parents"):
-            if d["status"] != "success": return False # Waiting on dependencies
+            if d["status"] not in DONE_STATUSES: return False # Waiting on dependencies
         return True
 
+    # Compares the script, its job parameters and its parents' output hashes with the inputs of the last successful run
+    # Sets t["input_hashes"] whenever these are known, so they're recorded in the task log
+    # Tasks without parents (e.g. scrapers) have no known inputs, so always count as changed
+    # So do tasks whose last result wasn't recorded, since children may need it (see skip_unchanged)
+    def is_changed(self, t):
+        if not t["parents"]: return True
+        if any(p.get("output_hashes") is None for p in t["parents"]): return True
+        own = [t["script_hash"], hash_json(job_params(t["job"]))] # Editing the script or its job also counts
+        t["input_hashes"] = own + [h for p in t["parents"] for h in p["output_hashes"]]
+        last_run = t.get("last_run")
+        if not last_run or last_run.get("result") is None: return True
+        return last_run.get("input_hashes") != t["input_hashes"]
+
+    # Skip a task whose inputs haven't changed, passing on its last known outputs
+    # The last result is put back on the task, as if it had run, so children can use it (e.g. output_url)
+    def skip_unchanged(self, t):
+        t["result"] = t["last_run"]["result"]
+        t.update(t["result"])
+        t["status"] = "unchanged"
+        t["output_hashes"] = t["last_run"].get("output_hashes")
+        self.log_msg(f"{t['script']} inputs unchanged, skipping.")
+        self.log_task(t)
+
+    # Runs tasks as soon as their dependencies are met, until none are left
+    # Each worker takes the next ready task off the queue, and queues up any
+    # children that are no longer waiting on anything when it finishes
+    # Ready tasks with the longest critical path run first
+    async def run_tasks(self, tasks, forced, max_tasks):
+        self.set_critical_paths(tasks)
+        queue = asyncio.PriorityQueue()
+        order = itertools.count() # Tie-breaker, tasks can't be compared
+        enqueue = lambda t: queue.put_nowait((-t["critical_path"], next(order), t))
+        for t in tasks:
+            if self.is_ready(t, forced): enqueue(t)
+        async def worker():
+            while True:
+                *_, t = await queue.get()
+                try:
+                    if self.is_changed(t) or forced:
+                        await self.run_task(t, forced)
+                    else:
+                        self.skip_unchanged(t) # Children can still run if their own inputs changed
+                    if t["status"] not in DONE_STATUSES: continue # Children will be skipped
+                    for c in t["children"]:
+                        c["pending_parents"] -= 1
+                        if not c["pending_parents"] and self.is_ready(c, forced):
+                            enqueue(c)
+                finally:
+                    queue.task_done()
+        workers = [asyncio.ensure_future(worker()) for i in range(max_tasks)]
+        finished = asyncio.ensure_future(queue.join())
+        try:
+            await asyncio.wait([finished, *workers], return_when = asyncio.FIRST_COMPLETED)
+            for w in workers:
+                if w.done(): w.result() # Workers only stop if a task raised
+        finally:
+            for w in workers + [finished]: w.cancel() # Terminates anything still running
+            await asyncio.gather(*workers, finished, return_exceptions = True)
+            if self.redraw: self.draw_status() # Don't leave a repaint on a loop that's about to close
+
+
+    # Longest chain of estimated runtimes from each task to the end of the run
+    def set_critical_paths(self, tasks):
+        for t in reversed(get_topo_order(tasks)):
+            downstream = [c.get("critical_path", 0) for c in t["children"]]
+            t["critical_path"] = self.estimate_runtime(t) + max(downstream, default = 0)
+
+    # Seconds taken by the last successful run, if we know it
+    def estimate_runtime(self, t):
+        last_run = t.get("last_run")
+        if last_run and last_run["start"] and last_run["end"]:
+            return (last_run["end"] - last_run["start"]).total_seconds()
+        return 1
+
 
     #================#
     #   Subprocess   #
     #================#
     # Run a single task as a subprocess
     async def run_task(self, t, forced = False):
-        self.on_task_ready(t)
-        pipe = asyncio.subprocess.PIPE
-        proc = await asyncio.create_subprocess_exec(*t["args"], stdout = pipe, stderr = pipe)
+        await run_event(self.on_task_ready, t)
+        loop = asyncio.get_running_loop()
+        pipe = subprocess.PIPE
+        spawn = lambda: subprocess.Popen(t["args"], stdout = pipe, stderr = pipe, close_fds = True)
+        spawning = loop.run_in_executor(self.spawn_pool, spawn)
+        try:
+            proc = await asyncio.shield(spawning) # The spawn can't be called off once it's started
+        except asyncio.CancelledError:
+            await asyncio.wait([spawning]) # Stop the subprocess rather than leaving it running unread
+            if not spawning.exception():
+                await loop.run_in_executor(None, stop_process, spawning.result())
+            raise
+        wait = lambda: loop.run_in_executor(None, proc.wait) # Brief, only called once the pipes have closed
+        t0 = time.perf_counter_ns()
         t["start"] = datetime.now()
         t["status"] = "running"
         self.log_msg(f"{t['script']} starting...") # Don't start the task until the subprocess has been created
         try:
-            stdout, stderr = [s.decode().strip() for s in await proc.communicate()]
+            stdout, stderr = await asyncio.gather(
+                read_pipe(proc.stdout),
+                read_pipe(proc.stderr, max_size = 1 << 18)) # Only the end of stderr is useful for errors
+            await wait()
             t["end"] = datetime.now()
+            t["elapsed_ns"] = time.perf_counter_ns() - t0 # Monotonic, unlike end - start
             t["stdout"] = stdout
             t["stderr"] = stderr
             assert proc.returncode == 0
-            self.on_task_success(t, stdout, stderr)
+            await run_event(self.on_task_success, t, stdout, stderr)
             self.log_msg(f"{t['script']} finished with status '{t['status']}'.")
         except AssertionError:
-            self.on_task_fail(t, stdout, stderr)
+            await run_event(self.on_task_fail, t, stdout, stderr)
             self.log_msg(f"{t['script']} failed!", "error")
             if not forced: raise # Ignore fails if forced
         finally:
-            if proc.returncode is None: # Only terminate if it hasn't finished
-                proc.terminate()
-                await proc.wait() # Wait for subprocess to terminate
+            if proc.poll() is None: # Only terminate if it hasn't finished (e.g. we were cancelled)
+                await asyncio.shield(loop.run_in_executor(None, stop_process, proc))
                 t["status"] = "terminated"
-            self.on_task_complete(t)
+            await run_event(self.on_task_complete, t)
+            self.log_task(t)
         return t
 
     # Verifies a single task and compiles everything it needs to run
@@ -208,22 +343,37 @@ class Taskmaster:
             "script": script,
             "status": "unassigned", # All tasks start out unassigned
             "job": job,
+            "last_run": self.get_last_run(script),
+            "script_hash": hash_file(fn),
+            "base_args": None, # Worked out when first needed, see prep_base_args()
             "parents": [],
             "children": []
         }
 
+    # Python interpreter for running scripts
+    # Only called directly when the environment (including .env) is already loaded, since
+    # scripts inherit it; otherwise "pipenv run" is needed to load .env for each task
+    def find_python(self):
+        if os.environ.get("TASKMASTER_PY"):
+            return [os.environ["TASKMASTER_PY"]]
+        if os.environ.get("PIPENV_ACTIVE"):
+            return [sys.executable] # Already inside pipenv, which has loaded .env
+        return ["pipenv", "run", "python"]
+
+    # Command for running a script, based on its extension
+    def get_base_args(self, fn):
+        ext = os.path.splitext(fn)[1].lower()
+        runner = self.runners.get(ext)
+        if runner is None:
+            raise Exception(f"I don't know how to run files with '{ext}' extensions!")
+        return [*runner, str(fn)]
+
     # Prepare arguments for subprocesses
+    # Unknown script types only fail when they're actually run
     def prep_base_args(self, t):
-        name, ext = t["script"].lower().split(".")
-        script_fn = str(self.scripts_path.joinpath(t["script"]))
-        if ext == "py":
-            args = ["pipenv", "run", "python", script_fn]
-        elif ext == "r":
-            args = ["Rscript", script_fn]
-        else:
-            raise Exception(f"I don't know how to run files with '.{ext}' extensions!")
-        return args
-
+        if t["base_args"] is None:
+            t["base_args"] = self.get_base_args(self.scripts_path.joinpath(t["script"]))
+        return list(t["base_args"]) # Copy, so events can append to it safely
 
     #=================#
     #   Task events   #
@@ -236,6 +386,7 @@ class Taskmaster:
     # If task returned a code == 0
     def on_task_success(self, t, stdout, stderr):
         r = read_result(stdout)
+        t["result"] = r # Kept in the task log, so it can be restored if the task is skipped next time
         t.update(r) # All outputs are saved to the task
 
     # If task returned a code != 0
@@ -250,6 +401,7 @@ class Taskmaster:
     # When the entire run is finished
     def on_run_complete(self):
         if not self.auto: return # Only report when running in auto
+        from chatter import send_card # Only needed for reports, don't pay for it otherwise
         print("Sending run report...")
         body = [simple_run_card(**self.run_log)] # Default run notification
         if hasattr(self, "dump"):
@@ -279,29 +431,73 @@ class Taskmaster:
     #=============#
     #   Logging   #
     #=============#
+    # While tasks are running, repaints are put off briefly so a burst of messages only redraws once
     def print_status(self, logs_size = 6):
-        if self.auto: return # No in-place screen in auto mode
-        if self.screen:
-            for l in self.screen.split("\n"):
-                print('\033[1A', end='\x1b[2K')
-        self.screen = ""
+        if self.auto or not IS_TTY: return # No in-place screen in auto mode or when piped
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return self.draw_status(logs_size) # Outside the event loop, draw straight away
+        if not self.redraw:
+            self.redraw = loop.call_later(REDRAW_DELAY, self.draw_status, logs_size)
+
+    def draw_status(self, logs_size = 6):
+        if self.redraw: self.redraw.cancel()
+        self.redraw = None
+        screen = ""
         if hasattr(self, "tasks"):
-            self.screen += draw_tree(self.tasks) + "\n"
+            statuses = [t["status"] for t in self.tasks]
+            if statuses != self.tree_statuses: # Only redraw the tree if a status has changed
+                self.tree = draw_tree(self.tasks)
+                self.tree_statuses = statuses
+            screen += self.tree + "\n"
         if hasattr(self, "log_msg"):
-            self.screen += draw_message_box(self.log_msgs, logs_size) + "\n"
+            screen += draw_message_box(self.log_msgs, logs_size) + "\n"
         if hasattr(self, "dump"):
-            self.screen += draw_dump(*self.dump)
-        print(self.screen)
+            screen += draw_dump(*self.dump)
+        if screen == self.screen: return # Nothing to repaint
+        sys.stdout.write(draw_screen_diff(self.screen, screen)) # One write per repaint
+        sys.stdout.flush()
+        self.screen = screen
 
     def log_msg(self, message, level = "info"):
         message = message.strip()
         log_msg = (datetime.now(), message, level)
         self.log_msgs.append(log_msg)
         self.print_status()
-        if self.auto: print(draw_message(*log_msg)) # Print messages immediate in auto mode
+        if self.auto or not IS_TTY: print(draw_message(*log_msg)) # Print messages immediately if there's no screen
+
+    # Last successful run of each script, from the task log
+    # Only the latest row for each script is read, using the index
+    def read_task_log(self):
+        last_runs = {}
+        if not self.task_log or not os.path.isfile(self.task_log): return last_runs
+        with closing(open_task_log(self.task_log)) as conn:
+            for row in conn.execute(TASK_LOG_LAST_RUNS):
+                row = dict(zip(TASK_LOG_FIELDS, row))
+                last_runs[row["script"]] = parse_task_log_row(row)
+        return last_runs
+
+    def get_last_run(self, script):
+        return self.last_runs.get(script)
+
+    # Rows are held until write_task_log() at the end of the run
+    def log_task(self, t):
+        if not self.task_log: return
+        row = { k: t.get(k) for k in TASK_LOG_FIELDS }
+        self.task_log_rows.append(row)
+        if row["status"] == "success": self.last_runs[row["script"]] = row
+
+    def write_task_log(self):
+        if not self.task_log or not self.task_log_rows: return
+        rows = [format_task_log_row(r) for r in self.task_log_rows]
+        with closing(open_task_log(self.task_log)) as conn, conn: # Commits in one transaction
+            conn.executemany(TASK_LOG_INSERT, [[r[k] for k in TASK_LOG_FIELDS] for r in rows])
+        self.task_log_rows = []
 
     def create_run_log(self):
         if not self.log_db: return
+        from sqltools import insert, delete # Only needed with a log_db
         where = { "run_name": self.run_name }
         row_count = delete(where, **self.log_db)
         if row_count:
@@ -314,44 +510,91 @@ class Taskmaster:
         self.run_log.update(row)
         insert(row, **self.log_db)
 
+    # Changes are buffered until flush_run_log(), so they can be set as often as needed
     def set_run_log(self, set):
-        if not self.log_db: return
+        self.run_log.update(set)
+        if self.log_db: self.pending_run_log.update(set)
+
+    # Write all pending changes in a single UPDATE
+    def flush_run_log(self):
+        if not self.pending_run_log: return
+        from sqltools import update # Only needed with a log_db
+        pending, self.pending_run_log = self.pending_run_log, {}
         where = {
             "run_name": self.run_name
         }
-        self.run_log.update(set)
-        update(where, set, **self.log_db)
+        update(where, pending, **self.log_db)
 
 
 #===========#
 #  Helpers  #
 #===========#
+# Tasks are dicts (unhashable), so dedup on identity, keeping the order
 def get_uniq(items):
-    out = []
+    seen = {}
     for i in items:
-        if i not in out: out.append(i)
-    return out
+        seen.setdefault(id(i), i)
+    return list(seen.values())
 
 def get_ancestors(t):
-    out = [] + t["parents"]
-    for p in t["parents"]:
-        out += get_ancestors(p)
-    return out
+    return get_relatives(t, "parents")
 
 def get_descendents(t):
-    out = [] + t["children"]
-    for c in t["children"]:
-        out += get_descendents(c)
+    return get_relatives(t, "children")
+
+# Breadth-first walk along parents/children, visiting each task only once
+# (a recursive walk revisits shared ancestors once per path)
+# Tasks already in seen are skipped (and seen is updated), so it can be shared between walks
+def get_relatives(t, direction, seen = None):
+    seen = set() if seen is None else seen
+    out = []
+    queue = deque(t[direction])
+    while queue:
+        r = queue.popleft()
+        if id(r) in seen: continue
+        seen.add(id(r))
+        out.append(r)
+        queue.extend(r[direction])
     return out
 
+# Order tasks so that every task comes after its parents (Kahn's algorithm)
+def get_topo_order(tasks):
+    waiting = { id(t): len(t["parents"]) for t in tasks }
+    queue = deque([t for t in tasks if not t["parents"]])
+    out = []
+    while queue:
+        t = queue.popleft()
+        out.append(t)
+        for c in t["children"]:
+            waiting[id(c)] -= 1
+            if not waiting[id(c)]: queue.append(c)
+    return out
+
+# Task events can be plain functions or coroutines
+async def run_event(event, *args):
+    res = event(*args)
+    if inspect.isawaitable(res): await res
+
 # Use Semaphore to limit the number of concurrent tasks
 async def gather_with_concurrency(tasks, max_tasks):
     semaphore = asyncio.Semaphore(max_tasks) # Use Semaphore to limit the number of concurrent tasks
     async def sem_task(task):
-        async with semaphore:
-            return await task
-    res = await asyncio.gather(*(sem_task(task) for task in tasks))
-    return res
+        try:
+            async with semaphore:
+                return await task
+        finally:
+            if inspect.iscoroutine(task): task.close() # Tidies up if cancelled before it started
+    futures = [asyncio.ensure_future(sem_task(task)) for task in tasks]
+    if not futures: return []
+    try:
+        done, _ = await asyncio.wait(futures, return_when = asyncio.FIRST_EXCEPTION)
+    finally:
+        # Cancel the rest if one fails (or we're cancelled), rather than leaving them running
+        for f in futures: f.cancel()
+        await asyncio.gather(*futures, return_exceptions = True)
+    for f in done:
+        if f.exception(): raise f.exception()
+    return [f.result() for f in futures]
 
 
 #===========#
@@ -365,22 +608,175 @@ def dump_result(payload):
     sys.stdout.write(out)
 
 # Extract results from a text block
+# The last block is used, and its JSON can span multiple lines
 def read_result(raw):
-    exp = r"== RESULT START ==\n(.*)\n== RESULT END =="
-    res = re.search(exp, raw)[1]
+    start, end = "== RESULT START ==\n", "\n== RESULT END =="
+    i = raw.rfind(start)
+    j = raw.find(end, i) if i >= 0 else -1
+    if j >= 0:
+        res = raw[i + len(start):j] # Fast path, no regex needed
+    else:
+        matches = RESULT_EXP.findall(raw) # Last block is incomplete, look for an earlier one
+        if not matches: raise Exception("No result found in output!")
+        res = matches[-1]
     out = json.loads(res)
     return out
 
+# Read a subprocess stream to the end, only keeping the last max_size bytes
+# The result block is picked out as it goes past (markers can be split across
+# chunks), then put back in front if it has fallen out of the kept tail
+async def read_output(stream, max_size = 1 << 20, chunk_size = 1 << 16):
+    start, end = b"== RESULT START ==\n", b"\n== RESULT END =="
+    tail = deque() # Chunks as read, capped at max_size bytes in total (pipes often return a line at a time)
+    size = 0
+    scan = b"" # Unmatched bytes, carried over in case a marker is split
+    block = None # Result block being read, if we're inside one
+    result = None # Last complete result block
+    truncated = False
+    while True:
+        chunk = await stream.read(chunk_size)
+        if not chunk: break
+        tail.append(chunk)
+        size += len(chunk)
+        while size > max_size: # Drop the oldest bytes, trimming the oldest chunk if that's enough
+            excess = size - max_size
+            if len(tail[0]) <= excess:
+                size -= len(tail.popleft())
+            else:
+                tail[0] = tail[0][excess:]
+                size -= excess
+            truncated = True
+        scan += chunk
+        while True:
+            if block is None:
+                i = scan.find(start)
+                if i < 0:
+                    scan = scan[-(len(start) - 1):]
+                    break
+                scan = scan[i + len(start):]
+                block = bytearray()
+            else:
+                i = scan.find(end)
+                if i < 0:
+                    cut = max(len(scan) - len(end) + 1, 0)
+                    block += scan[:cut]
+                    scan = scan[cut:]
+                    break
+                result = bytes(block + scan[:i])
+                block = None
+                scan = scan[i + len(end):]
+    out = b"".join(tail)
+    if truncated: # Start on a whole line, and make it clear that some is missing
+        i = out.find(b"\n")
+        out = b"[...earlier output truncated...]" + (out[i:] if i >= 0 else b"\n" + out)
+    if result is not None and start + result + end not in out:
+        out = b"\n" + start + result + end + b"\n" + out
+    return out.decode(errors = "replace").strip()
+
+# Terminate a subprocess (killing it if it won't stop) and wait for it, so it isn't left behind
+def stop_process(proc, timeout = 5):
+    if proc.poll() is None:
+        proc.terminate()
+        try:
+            proc.wait(timeout)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+    for pipe in (proc.stdout, proc.stderr):
+        if pipe: pipe.close()
+
+# Wrap a subprocess pipe in a StreamReader and read it with read_output()
+async def read_pipe(pipe, **kwargs):
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    transport, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), pipe)
+    try:
+        return await read_output(reader, **kwargs)
+    finally:
+        transport.close() # Already closed at EOF, but not if we were cancelled
+
 # Looks for output and hashes it
+# hashlib releases the GIL while hashing, so multiple files hash in parallel
 def hash_output(t):
     urls = t.get("output_urls")
     if not urls: return
-    t["output_md5s"] = []
     if type(urls) is str: urls = urls.split(", ")
-    for url in urls:
-        with open(url, "rb") as f:
-            h = hashlib.md5(f.read())
-            t["output_md5s"].append(h.hexdigest())
+    with ThreadPoolExecutor(max_workers = min(HASH_WORKERS, len(urls))) as pool:
+        t["output_hashes"] = list(pool.map(hash_file, urls))
+
+# Same as hash_output(), but hashes on worker threads without blocking the event loop
+# For use in async task events, e.g. "async def on_task_success(...)"
+# Capped at HASH_WORKERS files at once, like hash_output()
+async def hash_output_async(t):
+    urls = t.get("output_urls")
+    if not urls: return
+    if type(urls) is str: urls = urls.split(", ")
+    hashes = [asyncio.to_thread(hash_file, u) for u in urls] # Threads only start once awaited
+    t["output_hashes"] = await gather_with_concurrency(hashes, HASH_WORKERS)
+
+# Files that haven't changed since they were last hashed (same path, mtime and size) aren't hashed again
+def hash_file(fn):
+    st = os.stat(fn)
+    key = (os.path.abspath(fn), st.st_mtime_ns, st.st_size, HASH_ALGORITHM)
+    with HASH_CACHE_LOCK:
+        digest = HASH_CACHE.get(key)
+        if digest is not None: HASH_CACHE.move_to_end(key)
+    if digest is None:
+        digest = digest_file(fn) # Outside the lock, so other files hash in parallel
+        with HASH_CACHE_LOCK:
+            HASH_CACHE[key] = digest
+            if len(HASH_CACHE) > HASH_CACHE_SIZE: HASH_CACHE.popitem(last = False)
+    return digest
+
+# Hashes straight from the page cache with mmap, so there's no copying and memory use doesn't grow with file size
+# Falls back to streaming through a reused buffer where mmap doesn't work (e.g. empty files)
+# (hashlib.file_digest does the same, but requires Python 3.11)
+def digest_file(fn, chunk_size = 1 << 20):
+    h = hashlib.new(HASH_ALGORITHM)
+    with open(fn, "rb", buffering = 0) as f:
+        try:
+            with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as mm:
+                h.update(mm)
+            return h.hexdigest()
+        except (ValueError, OSError):
+            pass
+        buf = memoryview(bytearray(chunk_size))
+        while True:
+            n = f.readinto(buf)
+            if not n: break
+            h.update(buf[:n])
+    return h.hexdigest()
+
+# Hash of anything JSON-able, with keys sorted so it's stable between runs
+def hash_json(payload):
+    raw = json.dumps(payload, sort_keys = True, default = str).encode()
+    return hashlib.new(HASH_ALGORITHM, raw).hexdigest()
+
+# Job-wide parameters, without the steps (adding a step doesn't change the existing tasks)
+def job_params(job):
+    return { k: v for k, v in job.items() if k != "steps" }
+
+def open_task_log(fn):
+    conn = sqlite3.connect(fn)
+    conn.executescript(TASK_LOG_SCHEMA)
+    return conn
+
+# Task log rows are stored as flat strings
+def format_task_log_row(row):
+    out = {}
+    for k,v in row.items():
+        if v is None: out[k] = ""
+        elif type(v) in (list, dict): out[k] = json.dumps(v)
+        else: out[k] = str(v)
+    return out
+
+def parse_task_log_row(row):
+    out = dict(row)
+    for k in ["start", "end"]:
+        out[k] = datetime.fromisoformat(row[k]) if row[k] else None
+    for k in ["input_hashes", "output_hashes", "result"]:
+        out[k] = json.loads(row[k]) if row[k] else None
+    return out
 
 
 #===============#
@@ -393,6 +789,7 @@ def draw_message(msg_datetime, message, level = "info"):
         "warning": "\033[1;33m",
         "info": ""
     }
+    if not IS_TTY: return f"{msg_datetime:%H:%M:%S}: {message}"
     return f"{msg_datetime:%H:%M:%S}: {LEVEL_COLOURS[level]}{message}\033[0m"
 
 def draw_message_box(messages, logs_size = 6):
@@ -405,36 +802,71 @@ def draw_message_box(messages, logs_size = 6):
 
 def draw_tree(tasks):
     top_level = [t for t in tasks if not t["parents"]]
-    out = ""
-    for t in top_level:
-        out += draw_branch(t, is_top = True)
-    return out
+    return "".join([p for t in top_level for p in draw_branch(t, is_top = True)])
 
-# Recursive branch print used by draw_tree()
+# Branch print used by draw_tree(), yields pieces to be joined
+# Walks with an explicit stack, so long chains of steps don't run into the recursion limit
 def draw_branch(t, prefix = "", is_top = False, is_last = False):
-    script = t["script"]
-    status = t["status"]
-    colour = STATUSES.get(status) or STATUSES["default"]
-    body = f"{script} [{colour}{status}\033[0m]\n"
-    if is_top:
-        out = f"\n{body}"
-        prefix = ""
-    elif is_last:
-        out = f"{prefix}└── {body}"
-        prefix += "    "
+    stack = [(t, prefix, is_top, is_last)]
+    while stack:
+        t, prefix, is_top, is_last = stack.pop()
+        status = t["status"]
+        tag = STATUS_TAGS.get(status) or f"[{STATUS_COLOURS['default']}{status}{STATUS_COLOURS['reset']}]"
+        if is_top:
+            yield "\n"
+            prefix = ""
+        elif is_last:
+            yield f"{prefix}└── "
+            prefix += "    "
+        else:
+            yield f"{prefix}├── "
+            prefix += "│   "
+        yield t["script"]
+        yield " "
+        yield tag
+        yield "\n"
+        last = len(t["children"]) - 1
+        for i in range(last, -1, -1): # Reversed, so the first child comes off the stack first
+            stack.append((t["children"][i], prefix, False, i == last))
+
+# Escape codes to turn the old screen into the new one, rewriting only the lines that changed
+# If most lines below the first change are different anyway, they're cleared in one go
+# The cursor starts and ends on the line below the screen
+def draw_screen_diff(old, new):
+    old_lines = old.split("\n") if old else []
+    new_lines = new.split("\n")
+    changed = [i for i, line in enumerate(new_lines) if i >= len(old_lines) or line != old_lines[i]]
+    first = changed[0] if changed else len(new_lines)
+    out = []
+    row = len(old_lines)
+    def move_to(i):
+        if i < row: out.append(f"\033[{row - i}A")
+        if i > row: out.append(f"\033[{i - row}B")
+        out.append("\r")
+        return i
+    if len(changed) * 2 >= len(new_lines) - first: # Cheaper to clear and reprint the rest
+        row = move_to(first)
+        out.append("\033[J" + "".join(f"{line}\n" for line in new_lines[first:]))
+        return "".join(out)
+    for i in changed:
+        if i >= len(old_lines): break
+        row = move_to(i)
+        out.append(f"\x1b[2K{new_lines[i]}")
+    if len(new_lines) > len(old_lines):
+        row = move_to(len(old_lines))
+        out.append("".join(f"\x1b[2K{line}\n" for line in new_lines[len(old_lines):]))
     else:
-        out = f"{prefix}├── {body}"
-        prefix += "│   "
-    for c in t["children"]:
-        out += draw_branch(c, prefix, is_last = c == t["children"][-1])
-    return out
+        row = move_to(len(new_lines))
+        out.append("\033[J") # Clear anything left over from a longer screen
+    return "".join(out)
 
 def draw_dump(t, stdout, stderr):
     safe_args = [re.sub(r"([\s])", r"\\\1", a) for a in t["args"]]
+    c, r = ("\033[1;36m", "\033[0m") if IS_TTY else ("", "")
     return (
-        f"\n\033[1;36m===  stdout  ===\033[0m\n{stdout or '[stdout is empty]'}" +
-        f"\n\033[1;36m===  stderr  ===\033[0m\n{stderr or '[stderr is empty]'}" +
-        f"\n\033[1;36m===  Command  ===\033[0m\n{' '.join(safe_args)}"
+        f"\n{c}===  stdout  ==={r}\n{stdout or '[stdout is empty]'}" +
+        f"\n{c}===  stderr  ==={r}\n{stderr or '[stderr is empty]'}" +
+        f"\n{c}===  Command  ==={r}\n{' '.join(safe_args)}"
     )
 
 
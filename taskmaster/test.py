@@ -0,0 +1,70 @@
+# Checks subprocess output is captured whole, run with: python -m taskmaster.test
+import os, sys, asyncio, tempfile, subprocess
+from taskmaster import Taskmaster, read_pipe, hash_file
+
+# A script that fails with a deep traceback, written to stderr a line at a time (as Python and R do)
+# after a screenful of paced stdout, so every pipe read returns a single line
+SCRIPT = """
+import sys, time
+for i in range(60):
+    print(f"line {i}", flush = True)
+    time.sleep(0.002)
+def fail(n):
+    if n: fail(n - 1)
+    else: raise ValueError("test failure")
+fail(30)
+"""
+
+async def run_script():
+    pipe = subprocess.PIPE
+    proc = subprocess.Popen([sys.executable, "-c", SCRIPT], stdout = pipe, stderr = pipe)
+    stdout, stderr = await asyncio.gather(
+        read_pipe(proc.stdout),
+        read_pipe(proc.stderr, max_size = 1 << 18)) # Same cap as Taskmaster.run_task()
+    proc.wait()
+    return stdout, stderr
+
+# The same output, read in one go
+expected = subprocess.run([sys.executable, "-c", SCRIPT], capture_output = True, text = True)
+stdout, stderr = asyncio.run(run_script())
+assert stdout == expected.stdout.strip(), stdout
+assert stderr == expected.stderr.strip(), stderr
+assert stderr.startswith("Traceback (most recent call last):")
+assert stderr.endswith("ValueError: test failure")
+print("Output read intact.")
+
+
+# A chain a -> b -> c, where each task passes its output_url to the next (like the README example)
+# Editing only c.py skips b, which must still hand its last output_url to c
+CHAIN_SCRIPT = """
+import sys, json
+fn = sys.argv[0].replace(".py", ".out")
+open(fn, "w").write(str(sys.argv[1:]))
+print("\\n== RESULT START ==\\n" + json.dumps({ "status": "success", "output_url": fn }) + "\\n== RESULT END ==\\n")
+"""
+
+class ChainTaskmaster(Taskmaster):
+    def on_task_ready(self, t):
+        t["args"] = self.prep_base_args(t)
+        for p in t["parents"]:
+            t["args"].append(p["output_url"])
+
+    def on_task_success(self, t, stdout, stderr):
+        super().on_task_success(t, stdout, stderr)
+        t["output_hashes"] = [hash_file(t["output_url"])]
+
+def run_chain(path):
+    jobs = [{ "name": "chain", "steps": ["a.py", "b.py", "c.py"] }]
+    tm = ChainTaskmaster(jobs, scripts_path = path, task_log = os.path.join(path, "task_log.db"))
+    tm.run()
+    return { t["script"]: t["status"] for t in tm.tasks }
+
+os.environ["TASKMASTER_PY"] = sys.executable
+with tempfile.TemporaryDirectory() as path:
+    for script in ["a.py", "b.py", "c.py"]:
+        with open(os.path.join(path, script), "w") as f: f.write(CHAIN_SCRIPT)
+    assert run_chain(path) == { "a.py": "success", "b.py": "success", "c.py": "success" }
+    with open(os.path.join(path, "c.py"), "a") as f: f.write("# Edited\n")
+    assert run_chain(path) == { "a.py": "success", "b.py": "unchanged", "c.py": "success" }
+    with open(os.path.join(path, "c.out")) as f: assert "b.out" in f.read()
+print("Skipped task passed on its result.")